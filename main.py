@@ -1,12 +1,125 @@
+import asyncio
+import functools
 import json
 import os
 import re
 
+try:
+    import orjson
+except ImportError:  # orjson 为可选依赖，未安装时回退到标准库 json
+    orjson = None
+
 from astrbot.api.event import filter, AstrMessageEvent
 from astrbot.api.star import StarTools, Context, Star, register
 from astrbot.api import logger
 import astrbot.api.message_components as Comp
 
+# 支持的图片扩展名，本地路径只需做后缀判断
+_IMG_EXTS = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp')
+
+# 预编译的正则，避免每条消息重复解析
+_IMG_URL_RE = re.compile(r'^https?://.*\.(jpg|jpeg|png|gif|bmp|webp)', re.IGNORECASE)
+_IMG_TAG_RE = re.compile(r'\[(图片|img)\](\S+)', re.IGNORECASE)
+# 会话ID中以 _ 分隔、长度大于 6 的纯数字段即为群号
+_SESSION_GROUP_RE = re.compile(r'(?:^|_)(\d{7,})(?:_|$)')
+
+# 配置修改后延迟写盘的秒数，期间的多次修改合并为一次写入
+_SAVE_DELAY = 2.0
+
+
+def _dump_config(data: dict) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8")
+
+
+def _load_config_bytes(content: bytes) -> dict:
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+
+def _match_image_path(text: str, enable_img: bool, allow_net: bool) -> bool:
+    if not enable_img:
+        return False
+    text = text.strip()
+    # 单行且以图片扩展名结尾即视为本地图片
+    if '\n' not in text and text.lower().endswith(_IMG_EXTS):
+        return True
+    return bool(allow_net and _IMG_URL_RE.match(text))
+
+
+@functools.lru_cache(maxsize=256)
+def _parse_reply_segments(content: str, enable_img: bool, allow_net: bool) -> tuple:
+    """将回复内容解析为 ("text", 文本) / ("image", 路径) 片段
+
+    结果按原始内容和图片开关缓存，常用关键词命中时无需重复解析；
+    消息组件由调用方每次重新创建。
+    """
+    content = content.strip()
+    if not content:
+        return ()
+
+    # 如果是纯图片路径，直接返回图片
+    if _match_image_path(content, enable_img, allow_net):
+        return (("image", content),)
+
+    segments = []
+
+    # 检查是否包含图片标记
+    if '[图片]' in content or '[img]' in content:
+        # 处理包含图片的混合内容
+        lines = content.splitlines()
+
+        current_text = ""
+        for line in lines:
+            # 先做子串判断，只有可能含图片标记的行才跑正则
+            if '[图片]' in line or '[img]' in line.lower():
+                matches = list(_IMG_TAG_RE.finditer(line))
+            else:
+                matches = None
+
+            if not matches:
+                # 没有图片标记的行，直接添加到当前文本
+                current_text += line + "\n"
+            else:
+                # 有图片标记的行，需要拆分处理
+                last_end = 0
+                for match in matches:
+                    # 添加图片前的文本
+                    text_before = line[last_end:match.start()]
+                    if text_before.strip():
+                        current_text += text_before
+
+                    # 如果有累积的文本，先添加
+                    if current_text.strip():
+                        segments.append(("text", current_text))
+                        current_text = ""
+
+                    # 添加图片
+                    img_path = match.group(2).strip()
+                    if img_path:
+                        segments.append(("image", img_path))
+
+                    last_end = match.end()
+
+                # 添加图片后的剩余文本
+                remaining_text = line[last_end:]
+                if remaining_text.strip():
+                    current_text += remaining_text + "\n"
+                else:
+                    current_text += "\n"
+
+        # 添加最后剩余的文本
+        if current_text.strip():
+            segments.append(("text", current_text))
+    else:
+        # 纯文本内容，直接返回一个包含所有文本的片段
+        segments.append(("text", content))
+
+    return tuple(segments)
+
+
 @register(
     name="QQ群自定义关键词回复",
     desc="自定义关键词回复插件，支持文字、图片混合回复，群组独立配置，关键词管理，@用户回复，配置热切换。",
@@ -21,6 +134,10 @@ class KeywordReplyPlugin(Star):
         plugin_data_dir = StarTools.get_data_dir("astrbot_plugin_reply")
         self.config_path = os.path.join(plugin_data_dir, "keyword_reply_config.json")
         self.config = self._load_config()
+        self._rebuild_indexes()
+        self._save_lock = asyncio.Lock()
+        self._dirty = False
+        self._flush_task = None
         
         # 默认配置
         self.default_settings = {
@@ -48,31 +165,38 @@ class KeywordReplyPlugin(Star):
                 logger.info(f"配置已重新加载: {self.context.settings}")
         except Exception as e:
             logger.error(f"重新加载配置异常: {e}")
+        self._refresh_settings_cache()
 
-    def get_settings(self):
-        """获取当前有效配置"""
+    def _refresh_settings_cache(self):
+        """缓存当前有效配置，消息处理时直接读取缓存的开关"""
+        settings = self.default_settings
         try:
             if hasattr(self.context, "settings") and self.context.settings:
-                return self.context.settings
+                settings = self.context.settings
         except:
             pass
-        return self.default_settings
+        self._settings_cache = settings
+        self._reply_with_at = settings.get("reply_with_at", True)
+        self._group_separate = settings.get("group_separate", True)
+        self._enable_image_reply = settings.get("enable_image_reply", True)
+        self._allow_network_images = settings.get("allow_network_images", True)
+
+    def get_settings(self):
+        """获取当前有效配置（缓存，重载配置时刷新）"""
+        return self._settings_cache
 
     def _load_config(self) -> dict:
         default_config = {"global": {}, "groups": {}}
         try:
             if not os.path.exists(self.config_path):
-                os.makedirs(os.path.dirname(self.config_path), exist_ok=True)
-                with open(self.config_path, "w", encoding="utf-8") as f:
-                    json.dump(default_config, f, ensure_ascii=False, indent=2)
+                self._write_config_file(_dump_config(default_config))
                 return default_config
-            with open(self.config_path, "r", encoding="utf-8") as f:
+            with open(self.config_path, "rb") as f:
                 content = f.read().strip()
                 if not content:
-                    with open(self.config_path, "w", encoding="utf-8") as fw:
-                        json.dump(default_config, fw, ensure_ascii=False, indent=2)
+                    self._write_config_file(_dump_config(default_config))
                     return default_config
-                config = json.loads(content)
+                config = _load_config_bytes(content)
                 if "global" not in config:
                     config["global"] = {}
                 if "groups" not in config:
@@ -82,13 +206,65 @@ class KeywordReplyPlugin(Star):
             logger.error(f"配置加载失败: {e}")
             return default_config
 
-    def _save_config(self):
-        try:
-            os.makedirs(os.path.dirname(self.config_path), exist_ok=True)
-            with open(self.config_path, "w", encoding="utf-8") as f:
-                json.dump(self.config, f, ensure_ascii=False, indent=2)
-        except Exception as e:
-            logger.error(f"配置保存失败: {e}")
+    def _mark_dirty(self):
+        """标记配置已修改，由后台任务延迟合并写盘"""
+        self._dirty = True
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        while self._dirty:
+            await asyncio.sleep(_SAVE_DELAY)
+            await self._save_config()
+
+    async def _save_config(self):
+        """保存未写盘的配置，文件写入放到线程中执行，避免阻塞事件循环"""
+        async with self._save_lock:
+            if not self._dirty:
+                return
+            self._dirty = False
+            try:
+                # 在事件循环中序列化，保证拿到的是一致的配置快照
+                data = _dump_config(self.config)
+                await asyncio.to_thread(self._write_config_file, data)
+            except Exception as e:
+                logger.error(f"配置保存失败: {e}")
+
+    def _write_config_file(self, data: bytes):
+        os.makedirs(os.path.dirname(self.config_path), exist_ok=True)
+        with open(self.config_path, "wb") as f:
+            f.write(data)
+
+    @staticmethod
+    def _build_index(cfg: dict) -> dict:
+        """关键词 -> 回复原文，已禁用的关键词映射为 None"""
+        return {
+            keyword: data.get("raw", "") if data.get("enabled", True) else None
+            for keyword, data in cfg.items()
+        }
+
+    def _rebuild_indexes(self):
+        """根据当前配置重建关键词查找索引，配置变更后调用
+
+        每个有规则的群对应一份 全局 ∪ 本群 的合并索引（同名时群规则覆盖全局），
+        键 None 对应全局索引，消息处理时只需一次查找。
+        """
+        global_index = self._build_index(self.config.get("global", {}))
+        self._merged = {None: global_index}
+        for gid, cfg in self.config.get("groups", {}).items():
+            if cfg:
+                self._merged[gid] = {**global_index, **self._build_index(cfg)}
+        self._has_group_rules = len(self._merged) > 1
+        # 可触发回复的关键词长度与首字符，用于快速过滤不可能命中的消息
+        live_keywords = {
+            keyword
+            for index in self._merged.values()
+            for keyword, raw in index.items()
+            if raw is not None
+        }
+        self._key_lengths = {len(keyword) for keyword in live_keywords}
+        self._first_chars = {keyword[:1] for keyword in live_keywords}
+        self._has_any_rules = bool(live_keywords)
 
     def _get_group_id(self, event) -> str:
         try:
@@ -99,10 +275,9 @@ class KeywordReplyPlugin(Star):
                 return None
             session_id = event.get_session_id()
             if session_id and 'group' in session_id:
-                parts = session_id.split('_')
-                for part in parts:
-                    if part.isdigit() and len(part) > 6:
-                        return part
+                match = _SESSION_GROUP_RE.search(session_id)
+                if match:
+                    return match.group(1)
             return None
         except Exception as e:
             logger.error(f"获取群组ID失败: {e}")
@@ -120,6 +295,15 @@ class KeywordReplyPlugin(Star):
             self.config["global"] = {}
         return self.config["global"]
 
+    @staticmethod
+    def _parse_command(message: str, command: str):
+        """去除命令前缀（带或不带 /），返回参数部分；不是该命令时返回 None"""
+        if message.startswith("/" + command):
+            return message[len(command) + 1:]
+        if message.startswith(command):
+            return message[len(command):]
+        return None
+
     def _is_admin(self, event) -> bool:
         try:
             if event.is_admin():
@@ -135,85 +319,21 @@ class KeywordReplyPlugin(Star):
             return False
 
     def _is_image_path(self, text: str) -> bool:
-        settings = self.get_settings()
-        enable_img = settings.get('enable_image_reply', True)
-        allow_net = settings.get('allow_network_images', True)
-        if not enable_img:
-            return False
-        text = text.strip()
-        patterns = [r'^.*\.(jpg|jpeg|png|gif|bmp|webp)$']
-        if allow_net:
-            patterns.append(r'^https?://.*\.(jpg|jpeg|png|gif|bmp|webp)')
-        return any(re.match(p, text, re.IGNORECASE) for p in patterns)
+        return _match_image_path(text, self._enable_image_reply, self._allow_network_images)
 
     def _parse_reply_to_message_chain(self, content: str):
         """解析回复内容为消息链，完全保留原始格式"""
-        content = content.strip()
-        if not content:
-            return []
-        
-        # 如果是纯图片路径，直接返回图片
-        if self._is_image_path(content):
-            img_path = content.strip()
-            if img_path.lower().startswith(('http://', 'https://')):
-                return [Comp.Image.fromURL(img_path)]
-            else:
-                return [Comp.Image.fromFileSystem(img_path)]
-        
+        segments = _parse_reply_segments(
+            content, self._enable_image_reply, self._allow_network_images
+        )
         chain = []
-        
-        # 检查是否包含图片标记
-        if '[图片]' in content or '[img]' in content:
-            # 处理包含图片的混合内容
-            lines = content.splitlines()
-            img_pattern = r'\[(图片|img)\](\S+)'
-            
-            current_text = ""
-            for line in lines:
-                # 查找图片标记
-                matches = list(re.finditer(img_pattern, line, re.IGNORECASE))
-                
-                if not matches:
-                    # 没有图片标记的行，直接添加到当前文本
-                    current_text += line + "\n"
-                else:
-                    # 有图片标记的行，需要拆分处理
-                    last_end = 0
-                    for match in matches:
-                        # 添加图片前的文本
-                        text_before = line[last_end:match.start()]
-                        if text_before.strip():
-                            current_text += text_before
-                        
-                        # 如果有累积的文本，先添加
-                        if current_text.strip():
-                            chain.append(Comp.Plain(current_text))
-                            current_text = ""
-                        
-                        # 添加图片
-                        img_path = match.group(2).strip()
-                        if img_path:
-                            if img_path.lower().startswith(('http://', 'https://')):
-                                chain.append(Comp.Image.fromURL(img_path))
-                            else:
-                                chain.append(Comp.Image.fromFileSystem(img_path))
-                        
-                        last_end = match.end()
-                    
-                    # 添加图片后的剩余文本
-                    remaining_text = line[last_end:]
-                    if remaining_text.strip():
-                        current_text += remaining_text + "\n"
-                    else:
-                        current_text += "\n"
-            
-            # 添加最后剩余的文本
-            if current_text.strip():
-                chain.append(Comp.Plain(current_text))
-        else:
-            # 纯文本内容，直接返回一个包含所有文本的 Plain 对象
-            chain.append(Comp.Plain(content))
-        
+        for kind, value in segments:
+            if kind == "text":
+                chain.append(Comp.Plain(value))
+            elif value.lower().startswith(('http://', 'https://')):
+                chain.append(Comp.Image.fromURL(value))
+            else:
+                chain.append(Comp.Image.fromFileSystem(value))
         return chain
 
     def _check_keyword_limit(self, group_id: str) -> bool:
@@ -231,7 +351,7 @@ class KeywordReplyPlugin(Star):
     async def add_reply(self, event: AstrMessageEvent):
         settings = self.get_settings()
         group_id = self._get_group_id(event)
-        if not group_id and settings.get("group_separate", True):
+        if not group_id and self._group_separate:
             yield event.plain_result("❌ 此功能仅限群聊使用")
             return
         if not self._is_admin(event):
@@ -242,21 +362,12 @@ class KeywordReplyPlugin(Star):
             yield event.plain_result(f"❌ 关键词数量已达上限（{max_count}个）")
             return
         
-        # 获取原始消息内容
-        full_message = event.get_message_str()
-        
-        # 移除命令前缀部分
-        command_prefix1 = "/添加回复"
-        command_prefix2 = "添加回复"
-        
-        # 去除命令前缀
-        if full_message.startswith(command_prefix1):
-            args = full_message[len(command_prefix1):].strip()
-        elif full_message.startswith(command_prefix2):
-            args = full_message[len(command_prefix2):].strip()
-        else:
+        # 去除命令前缀，获取参数部分
+        args = self._parse_command(event.get_message_str(), "添加回复")
+        if args is None:
             yield event.plain_result("❌ 格式错误，请在消息前添加命令前缀：\"/添加回复\"")
             return
+        args = args.strip()
 
         # 使用第一个"|"作为分隔符
         parts = args.split("|", 1)
@@ -287,30 +398,31 @@ class KeywordReplyPlugin(Star):
             "enabled": settings.get("default_enabled", True)
         }
         
-        if group_id and settings.get("group_separate", True):
+        if group_id and self._group_separate:
             group_cfg = self._get_group_config(group_id)
             group_cfg[keyword] = reply_data
         else:
             global_cfg = self._get_global_config()
             global_cfg[keyword] = reply_data
             
-        self._save_config()
+        self._rebuild_indexes()
+        self._mark_dirty()
         yield event.plain_result(f"✅ 已添加关键词回复：{keyword}")
 
     @filter.command("查看回复")
     async def list_replies(self, event: AstrMessageEvent):
-        settings = self.get_settings()
         group_id = self._get_group_id(event)
-        if not group_id and settings.get("group_separate", True):
+        if not group_id and self._group_separate:
             yield event.plain_result("❌ 此功能仅限群聊使用")
             return
         global_cfg = self._get_global_config()
-        group_cfg = self._get_group_config(group_id) if group_id else {}
+        # 只读查询，不为未配置的群创建空配置
+        group_cfg = self.config.get("groups", {}).get(group_id, {}) if group_id else {}
         if not global_cfg and not group_cfg:
             yield event.plain_result("暂无自定义回复")
             return
 
-        msg = "关键词回复列表：\n"
+        lines = ["关键词回复列表：\n"]
         def preview_text(v):
             txt = v.get("raw", "")
             pre = txt.split("\n", 1)[0][:20] + ("..." if len(txt) > 20 else "")
@@ -318,46 +430,36 @@ class KeywordReplyPlugin(Star):
             return f"{pre}{' 📷x'+str(img_nums) if img_nums else ''}"
 
         if global_cfg:
-            msg += "\n【全局回复】\n"
+            lines.append("\n【全局回复】\n")
             for i, (k,v) in enumerate(global_cfg.items(),1):
                 status = "✅" if v.get("enabled", True) else "❌"
-                msg += f"{i}. {status} {k} -> {preview_text(v)}\n"
+                lines.append(f"{i}. {status} {k} -> {preview_text(v)}\n")
 
         if group_cfg and group_id:
-            msg += f"\n【群 {group_id} 回复】\n"
+            lines.append(f"\n【群 {group_id} 回复】\n")
             for i, (k,v) in enumerate(group_cfg.items(),1):
                 status = "✅" if v.get("enabled", True) else "❌"
-                msg += f"{i}. {status} {k} -> {preview_text(v)}\n"
+                lines.append(f"{i}. {status} {k} -> {preview_text(v)}\n")
 
-        yield event.plain_result(msg)
+        yield event.plain_result("".join(lines))
 
     @filter.command("删除回复")
     @filter.permission_type(filter.PermissionType.ADMIN)
     async def delete_reply(self, event: AstrMessageEvent):
-        settings = self.get_settings()
         group_id = self._get_group_id(event)
-        if not group_id and settings.get("group_separate", True):
+        if not group_id and self._group_separate:
             yield event.plain_result("❌ 此功能仅限群聊使用")
             return
         if not self._is_admin(event):
             yield event.plain_result("❌ 权限不足，需要管理员权限")
             return
             
-        # 获取原始消息内容
-        full_message = event.get_message_str()
-        
-        # 移除命令前缀部分
-        command_prefix1 = "/删除回复"
-        command_prefix2 = "删除回复"
-        
-        # 去除命令前缀
-        if full_message.startswith(command_prefix1):
-            keyword = full_message[len(command_prefix1):].strip()
-        elif full_message.startswith(command_prefix2):
-            keyword = full_message[len(command_prefix2):].strip()
-        else:
+        # 去除命令前缀，获取关键字
+        keyword = self._parse_command(event.get_message_str(), "删除回复")
+        if keyword is None:
             yield event.plain_result("❌ 格式错误，请在消息前添加命令前缀：\"/删除回复\"")
             return
+        keyword = keyword.strip()
             
         if not keyword:
             yield event.plain_result("❌ 请提供要删除的关键字")
@@ -378,7 +480,8 @@ class KeywordReplyPlugin(Star):
             yield event.plain_result(f"❌ 未找到关键词：{keyword}")
             return
             
-        self._save_config()
+        self._rebuild_indexes()
+        self._mark_dirty()
         yield event.plain_result(f"✅ 已删除关键词：{keyword}")
 
     @filter.command("重载配置")
@@ -390,6 +493,7 @@ class KeywordReplyPlugin(Star):
             return
             
         try:
+            await self._save_config()
             self._reload_settings()
             yield event.plain_result("✅ 配置重载成功")
         except Exception as e:
@@ -400,17 +504,19 @@ class KeywordReplyPlugin(Star):
     @filter.permission_type(filter.PermissionType.ADMIN)
     async def enable_reply(self, event: AstrMessageEvent):
         """启用指定关键词回复"""
-        settings = self.get_settings()
         group_id = self._get_group_id(event)
-        if not group_id and settings.get("group_separate", True):
+        if not group_id and self._group_separate:
             yield event.plain_result("❌ 此功能仅限群聊使用")
             return
         if not self._is_admin(event):
             yield event.plain_result("❌ 权限不足，需要管理员权限")
             return
             
-        full_msg = event.get_message_str()
-        keyword = full_msg.replace("/启用回复", "").replace("启用回复", "").strip()
+        keyword = self._parse_command(event.get_message_str(), "启用回复")
+        if keyword is None:
+            yield event.plain_result("❌ 格式错误，请在消息前添加命令前缀：\"/启用回复\"")
+            return
+        keyword = keyword.strip()
         if not keyword:
             yield event.plain_result("❌ 请提供要启用的关键字")
             return
@@ -432,24 +538,27 @@ class KeywordReplyPlugin(Star):
             yield event.plain_result(f"❌ 未找到关键词：{keyword}")
             return
             
-        self._save_config()
+        self._rebuild_indexes()
+        self._mark_dirty()
         yield event.plain_result(f"✅ 已启用关键词：{keyword}")
 
     @filter.command("禁用回复")
     @filter.permission_type(filter.PermissionType.ADMIN)
     async def disable_reply(self, event: AstrMessageEvent):
         """禁用指定关键词回复"""
-        settings = self.get_settings()
         group_id = self._get_group_id(event)
-        if not group_id and settings.get("group_separate", True):
+        if not group_id and self._group_separate:
             yield event.plain_result("❌ 此功能仅限群聊使用")
             return
         if not self._is_admin(event):
             yield event.plain_result("❌ 权限不足，需要管理员权限")
             return
             
-        full_msg = event.get_message_str()
-        keyword = full_msg.replace("/禁用回复", "").replace("禁用回复", "").strip()
+        keyword = self._parse_command(event.get_message_str(), "禁用回复")
+        if keyword is None:
+            yield event.plain_result("❌ 格式错误，请在消息前添加命令前缀：\"/禁用回复\"")
+            return
+        keyword = keyword.strip()
         if not keyword:
             yield event.plain_result("❌ 请提供要禁用的关键字")
             return
@@ -471,38 +580,37 @@ class KeywordReplyPlugin(Star):
             yield event.plain_result(f"❌ 未找到关键词：{keyword}")
             return
             
-        self._save_config()
+        self._rebuild_indexes()
+        self._mark_dirty()
         yield event.plain_result(f"✅ 已禁用关键词：{keyword}")
 
     @filter.event_message_type(filter.EventMessageType.ALL)
     async def handle_message(self, event: AstrMessageEvent):
-        settings = self.get_settings()
-        reply_with_at = settings.get("reply_with_at", True)
+        if not self._has_any_rules:
+            return
+        reply_with_at = self._reply_with_at
         msg = event.message_str.strip()
         
         if not msg:
             return
+        # 长度或首字符对不上任何关键词的消息直接跳过，绝大多数闲聊在此返回
+        if len(msg) not in self._key_lengths or msg[0] not in self._first_chars:
+            return
             
-        group_id = self._get_group_id(event)
-        reply_data = None
+        # 没有任何群组规则时无需解析群号
+        group_id = self._get_group_id(event) if self._has_group_rules else None
         
-        # 查找匹配的回复
-        if group_id:
-            group_cfg = self._get_group_config(group_id)
-            if msg in group_cfg:
-                reply_data = group_cfg[msg]
-                
-        if not reply_data:
-            global_cfg = self._get_global_config()
-            if msg in global_cfg:
-                reply_data = global_cfg[msg]
-                
-        if not reply_data or not reply_data.get("enabled", True):
+        # 查找匹配的回复，合并索引中群规则（包括已禁用的）已覆盖同名全局规则
+        raw_content = self._merged.get(group_id, self._merged[None]).get(msg)
+        if raw_content is None:
             return
             
-        raw_content = reply_data.get("raw", "")
         chain = []
         
+        # 命中全局规则且需要@用户时再解析群号
+        if reply_with_at and not self._has_group_rules:
+            group_id = self._get_group_id(event)
+        
         # 群聊中@用户
         if reply_with_at and group_id:
             # 使用 Comp.At 组件
@@ -519,3 +627,9 @@ class KeywordReplyPlugin(Star):
         
         if chain:
             yield event.chain_result(chain)
+
+    async def terminate(self):
+        """插件卸载时写入尚未保存的配置"""
+        await self._save_config()
+        if self._flush_task and not self._flush_task.done():
+            self._flush_task.cancel()